@@ -0,0 +1,20 @@
+# Gunicorn settings, picked up automatically from the working directory.
+# The app only waits on Hugging Face / Rekognition, so threaded workers
+# keep many upstream calls in flight per process.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+# In-flight HF calls per instance = workers * threads; raise threads first,
+# they are far cheaper than extra processes for this workload.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+keepalive = 30
+timeout = 120  # HF cold starts can hold a request open for a while
+
+# Keep off: main.py opens per-process state at import (HF pre-warm thread,
+# pooled HTTPS connections, SQLite handle, boto3 client) that must not be
+# created in the master and inherited across fork(). There are no local
+# model weights here for copy-on-write sharing to save.
+preload_app = False
@@ -1,8 +1,18 @@
-from flask import Flask, request, jsonify
-import os, requests, time, io
-from PIL import Image
+from flask import Flask, request
+import orjson
+import os, requests, io, time, threading, heapq, operator, hashlib, sqlite3, tempfile
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image, ImageOps
 import boto3
-from typing import Tuple, Dict, Any, Optional
+from botocore.config import Config
+from typing import Tuple, Dict, Any, Optional, BinaryIO, Union
+
+try:
+    from blake3 import blake3 as _hasher  # SIMD (SSE4.1/AVX2/AVX-512) at GB/s
+except ImportError:
+    _hasher = hashlib.sha256  # OpenSSL uses SHA-NI where the CPU has it
 
 MODEL_ID = os.environ.get("MODEL_ID", "chriamue/bird-species-classifier")
 HF_TOKEN = os.environ.get("HF_TOKEN")  # set this in App Runner
@@ -10,6 +20,20 @@ API_URL = f"https://api-inference.huggingface.co/models/{MODEL_ID}"
 
 AWS_REGION = os.getenv("AWS_REGION", "eu-west-1")
 BIRD_MIN_CONF = float(os.getenv("BIRD_MIN_CONF", "0.85"))
+STRICT_VALIDATION = os.getenv("STRICT_VALIDATION") == "1"  # full PIL verify on uploads
+
+# Uploads bigger than this are re-encoded as <= SHRINK_MAX_PX JPEG before
+# being sent to HF / Rekognition; the classifier only needs 224x224.
+SHRINK_OVER_BYTES = int(os.getenv("SHRINK_OVER_BYTES", "400000"))
+SHRINK_MAX_PX = int(os.getenv("SHRINK_MAX_PX", "1024"))
+# Never decode more than this on the request path; a tiny, highly compressed
+# PNG can still claim 100+ MP and cost hundreds of MB to decode.
+SHRINK_MAX_PIXELS = int(os.getenv("SHRINK_MAX_PIXELS", "40000000"))
+
+HF_CACHE_DB = os.getenv("HF_CACHE_DB", "hfcache.db")  # "" disables the SQLite tier
+HF_CACHE_MEM = int(os.getenv("HF_CACHE_MEM", "1024"))  # entries kept in-process
+HF_CACHE_ROWS = int(os.getenv("HF_CACHE_ROWS", "100000"))  # SQLite row cap
+HF_CACHE_TTL = int(os.getenv("HF_CACHE_TTL", str(7 * 24 * 3600)))  # seconds, both tiers
 
 # Proper headers for binary upload + better DX on cold start
 HEADERS = {
@@ -20,20 +44,241 @@ HEADERS = {
 if HF_TOKEN:
     HEADERS["Authorization"] = f"Bearer {HF_TOKEN}"
 
+RETRY_AFTER_MAX = 16  # seconds; cap on any upstream Retry-After we honor
+
+class _CappedRetry(Retry):
+    # urllib3 1.26 sleeps for whatever Retry-After says, which could park a
+    # worker thread indefinitely; clamp it.
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, RETRY_AFTER_MAX)
+
+# Cold starts are absorbed by x-wait-for-model above. urllib3 retries
+# network errors and 502/504 always, and 413/429/503 only when the response
+# carries Retry-After (urllib3's RETRY_AFTER_STATUS_CODES), waiting at most
+# RETRY_AFTER_MAX. Streamed bodies are rewound between attempts. The last
+# response is returned rather than raised so its error body reaches the client.
+_RETRY = _CappedRetry(
+    total=3,
+    backoff_factor=2,
+    status_forcelist=[502, 504],
+    allowed_methods={"GET", "POST"},
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# One connection pool for the whole process so HF calls reuse keep-alive
+# TLS connections; urllib3 pools are thread-safe, requests.Session is not.
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_RETRY)
+_local = threading.local()
+
+def get_session() -> requests.Session:
+    # one Session per thread, all sharing _ADAPTER's connection pool
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = requests.Session()
+        s.mount("https://", _ADAPTER)
+        s.headers.update(HEADERS)
+        _local.session = s
+    return s
+
+def _prewarm_hf():
+    # open the TLS connection before the first /predict needs it
+    try:
+        get_session().get("https://api-inference.huggingface.co/", timeout=5)
+    except requests.exceptions.RequestException:
+        pass
+
+if os.getenv("HF_PREWARM", "1") == "1":
+    threading.Thread(target=_prewarm_hf, daemon=True).start()
+
+# HF results cached by image content: in-process LRU in front of SQLite
+# (the file is shared by all gunicorn workers on the box). Best-effort:
+# any SQLite problem degrades to the in-memory tier, never to an error.
+_mem_lock = threading.Lock()  # guards _mem_cache only; never held across I/O
+_db_lock = threading.Lock()   # the SQLite connection is shared by all threads
+_mem_cache: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+def _open_cache_db() -> Optional[sqlite3.Connection]:
+    if not HF_CACHE_DB:
+        return None
+    try:
+        db = sqlite3.connect(HF_CACHE_DB, check_same_thread=False, timeout=1)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS hf_cache(k TEXT PRIMARY KEY, v BLOB, t REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS hf_cache_t ON hf_cache(t)")
+        db.commit()
+        return db
+    except sqlite3.Error:
+        return None  # e.g. unwritable path: run memory-only
+
+_db = _open_cache_db()
+
+def _image_key(stream: BinaryIO) -> str:
+    # hash in chunks so the upload never has to sit in memory as one bytes object
+    h = _hasher()
+    for chunk in iter(lambda: stream.read(1 << 16), b""):
+        h.update(chunk)
+    stream.seek(0)
+    return f"{MODEL_ID}:{h.hexdigest()[:32]}"
+
+def _cache_get(key: str) -> Optional[Any]:
+    now = time.time()
+    with _mem_lock:
+        hit = _mem_cache.get(key)
+        if hit is not None:
+            if now - hit[0] < HF_CACHE_TTL:
+                _mem_cache.move_to_end(key)
+                return hit[1]
+            del _mem_cache[key]
+
+    if _db is None:
+        return None
+    try:
+        with _db_lock:
+            row = _db.execute(
+                "SELECT v, t FROM hf_cache WHERE k = ? AND t > ?", (key, now - HF_CACHE_TTL)
+            ).fetchone()
+        if row is None:
+            return None
+        payload = orjson.loads(row[0])
+    except (sqlite3.Error, orjson.JSONDecodeError):
+        return None  # unreadable or corrupt row counts as a miss
+
+    _mem_put(key, row[1], payload)
+    return payload
+
+def _cache_put(key: str, payload: Any) -> None:
+    now = time.time()
+    _mem_put(key, now, payload)
+    if _db is None:
+        return
+    blob = orjson.dumps(payload)
+    try:
+        with _db_lock, _db:  # one transaction; rolled back on error
+            _db.execute("INSERT OR REPLACE INTO hf_cache(k, v, t) VALUES (?, ?, ?)", (key, blob, now))
+            # keep the table bounded: drop expired rows, then the oldest past the cap
+            _db.execute("DELETE FROM hf_cache WHERE t <= ?", (now - HF_CACHE_TTL,))
+            _db.execute(
+                "DELETE FROM hf_cache WHERE k IN "
+                "(SELECT k FROM hf_cache ORDER BY t DESC LIMIT -1 OFFSET ?)",
+                (HF_CACHE_ROWS,),
+            )
+    except sqlite3.Error:
+        pass  # cache is best-effort; never fail a prediction over it
+
+def _mem_put(key: str, stored_at: float, payload: Any) -> None:
+    with _mem_lock:
+        _mem_cache[key] = (stored_at, payload)
+        _mem_cache.move_to_end(key)
+        while len(_mem_cache) > HF_CACHE_MEM:
+            _mem_cache.popitem(last=False)
+
+_score = operator.itemgetter("score")  # HF always returns {label, score}
+
 app = Flask(__name__)
 
+def ojson(obj: Any, code: int = 200):
+    # orjson-backed stand-in for `jsonify(obj), code`; bytes are sent as-is
+    body = obj if isinstance(obj, bytes) else orjson.dumps(obj)
+    return app.response_class(body, status=code, mimetype="application/json")
+
+# Bodies that never change, serialized once at import
+_HEALTH = orjson.dumps({
+    "status": "ok",
+    "backend": "huggingface-inference-api",
+    "model": MODEL_ID,
+    "auth": "present" if HF_TOKEN else "missing"
+})
+_NO_FILE = orjson.dumps({"error": "No file uploaded. Use form-data with key 'file'."})
+_INVALID_IMAGE = orjson.dumps({"error": "Invalid image data"})
+
 @app.get("/")
 def health():
-    return jsonify({
-        "status": "ok",
-        "backend": "huggingface-inference-api",
-        "model": MODEL_ID,
-        "auth": "present" if HF_TOKEN else "missing"
-    }), 200
+    return ojson(_HEALTH, 200)
+
+def _looks_like_image(head: bytes) -> bool:
+    # magic-number sniff; rejects obvious non-images without decoding anything
+    return (
+        head[:3] == b"\xff\xd8\xff"                             # JPEG
+        or head[:8] == b"\x89PNG\r\n\x1a\n"                     # PNG
+        or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")      # WebP
+        or head[:4] == b"GIF8"                                  # GIF
+    )
+
+def _is_valid_image(stream: BinaryIO) -> bool:
+    """
+    Cheap header check on every upload; HF and Rekognition already reject
+    undecodable images with a 400. Set STRICT_VALIDATION=1 to also run a
+    full PIL verify.
+    Leaves the stream rewound to the start.
+    """
+    head = stream.read(32)
+    stream.seek(0)
+    if not _looks_like_image(head):
+        return False
+    if STRICT_VALIDATION:
+        try:
+            Image.open(stream).verify()
+        except Exception:
+            return False
+        finally:
+            stream.seek(0)
+    return True
+
+def _shrink(stream: BinaryIO) -> BinaryIO:
+    """
+    Downscale large uploads so we don't ship multi-MB photos upstream.
+    Returns a rewound stream: the original one if small, undecodable or
+    over SHRINK_MAX_PIXELS (upstream then deals with it), else a fresh JPEG.
+    """
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    if size <= SHRINK_OVER_BYTES:
+        return stream
+
+    try:
+        im = Image.open(stream)  # lazy: only the header is parsed here
+        w, h = im.size
+        if w * h > SHRINK_MAX_PIXELS:
+            stream.seek(0)
+            return stream
+        im.thumbnail((SHRINK_MAX_PX, SHRINK_MAX_PX), Image.BILINEAR)  # JPEG: uses draft() DCT scaling
+        im = ImageOps.exif_transpose(im)  # re-encoding drops EXIF, so bake in orientation
+        buf = io.BytesIO()
+        im.convert("RGB").save(buf, "JPEG", quality=85, optimize=False)
+    except Exception:
+        stream.seek(0)
+        return stream
+
+    buf.seek(0)
+    return buf
 
-def _rek():
-    # lazy client; created only when /VerifyBirdImage is hit
-    return boto3.client("rekognition", region_name=AWS_REGION)
+_SPOOL_MAX = 1024 * 500  # Werkzeug's default_stream_factory in-memory spool size
+
+def _upload_body(stream: BinaryIO) -> Union[bytes, BinaryIO]:
+    """
+    Pick what to hand requests as `data=`. It sizes file bodies via fileno(),
+    which forces an in-memory SpooledTemporaryFile to roll over to disk. A
+    spool no bigger than Werkzeug's spool size is still in memory, so send its
+    bytes instead. Larger spools (already on disk) and BytesIO are streamed.
+    """
+    if isinstance(stream, tempfile.SpooledTemporaryFile):
+        stream.seek(0, io.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        if size <= _SPOOL_MAX:
+            return stream.read()
+    return stream
+
+# One client per process: boto3 clients are thread-safe, and building one
+# per call repeats credential/signer setup. Pool sized for gthread workers.
+_REK = boto3.client(
+    "rekognition",
+    region_name=AWS_REGION,
+    config=Config(max_pool_connections=50, retries={"max_attempts": 2, "mode": "standard"}),
+)
 
 def _verify_with_rekognition(image_bytes: bytes) -> Tuple[Dict[str, Any], int]:
     """
@@ -42,7 +287,7 @@ def _verify_with_rekognition(image_bytes: bytes) -> Tuple[Dict[str, Any], int]:
     uniform_body keys: ok, label, confidence, message, error
     """
     try:
-        resp = _rek().detect_labels(
+        resp = _REK.detect_labels(
             Image={"Bytes": image_bytes},
             MaxLabels=25,
             MinConfidence=int(BIRD_MIN_CONF * 100)
@@ -89,98 +334,92 @@ def _verify_with_rekognition(image_bytes: bytes) -> Tuple[Dict[str, Any], int]:
 @app.route("/verify-bird-image", methods=["POST"])    # kebab alias
 def verify_bird_image():
     if "file" not in request.files:
-        return jsonify({"error": "No file uploaded. Use form-data with key 'file'."}), 400
+        return ojson(_NO_FILE, 400)
 
-    image_bytes = request.files["file"].read()
-    try:
-        Image.open(io.BytesIO(image_bytes)).verify()
-    except Exception:
-        return jsonify({"error": "Invalid image data"}), 400
+    upload = request.files["file"]
+    if not _is_valid_image(upload.stream):
+        return ojson(_INVALID_IMAGE, 400)
 
+    image_bytes = _shrink(upload.stream).read()  # Rekognition needs the raw bytes
     payload, _ = _verify_with_rekognition(image_bytes)
     # Always HTTP 200 for business outcomes; client inspects payload["ok"]
-    return jsonify(payload), 200
+    return ojson(payload, 200)
 
 @app.get("/__routes")
 def list_routes():
-    return jsonify(sorted([(r.rule, sorted(list(r.methods))) for r in app.url_map.iter_rules()]))
+    return ojson(sorted([(r.rule, sorted(list(r.methods))) for r in app.url_map.iter_rules()]))
 
-def call_hf_inference(image_bytes: bytes, retries: int = 3, timeout: int = 60):
+def call_hf_inference(image: Union[bytes, BinaryIO], timeout: int = 60):
     """
     Call Hugging Face Inference API safely.
+    - Accepts raw bytes or a seekable file object (streamed, not buffered).
     - Never raises; always returns (payload, http_status).
-    - Retries on 503 (cold start) and transient network errors with backoff.
+    - Cold starts are held open by HF (x-wait-for-model); 502/504 and
+      transient network errors are retried by the session adapter (_RETRY).
     """
-    delay = 2
-    last_err = None
-
-    for attempt in range(1, retries + 1):
-        try:
-            r = requests.post(API_URL, headers=HEADERS, data=image_bytes, timeout=timeout)
-
-            # Model still loading
-            if r.status_code == 503:
-                last_err = r.text
-                time.sleep(delay)
-                delay = min(delay * 2, 16)
-                continue
-
-            # Any non-2xx: surface HF error body
-            if not (200 <= r.status_code < 300):
-                try:
-                    body = r.json()
-                except Exception:
-                    body = {"raw": r.text}
-                body.setdefault("error", "HuggingFace request failed")
-                body.setdefault("status_code", r.status_code)
-                return body, r.status_code
+    try:
+        r = get_session().post(API_URL, data=image, timeout=timeout)
 
-            # Success
-            return r.json(), r.status_code
+        # Any non-2xx: surface HF error body
+        if not (200 <= r.status_code < 300):
+            try:
+                body = r.json()
+            except Exception:
+                body = {"raw": r.text}
+            body.setdefault("error", "HuggingFace request failed")
+            body.setdefault("status_code", r.status_code)
+            return body, r.status_code
 
-        except requests.exceptions.RequestException as e:
-            last_err = str(e)
-            time.sleep(delay)
-            delay = min(delay * 2, 16)
+        # Success
+        return r.json(), r.status_code
 
-    return {"error": "HuggingFace request exception or timeout", "detail": last_err}, 502
+    except requests.exceptions.RequestException as e:
+        return {"error": "HuggingFace request exception or timeout", "detail": str(e)}, 502
 
 
 @app.post("/predict")
 def predict():
     if "file" not in request.files:
-        return jsonify({"error": "No file uploaded. Use form-data with key 'file'."}), 400
+        return ojson(_NO_FILE, 400)
 
-    image_bytes = request.files["file"].read()
+    # Large uploads are streamed straight through instead of being copied
+    # into bytes (see _upload_body for the in-memory case).
+    stream = request.files["file"].stream
 
     # Basic sanity check that it’s an image
-    try:
-        Image.open(io.BytesIO(image_bytes)).verify()
-    except Exception:
-        return jsonify({"error": "Invalid image data"}), 400
-
-    payload, code = call_hf_inference(image_bytes)
-    if code != 200:
-        # Propagate HF error details (401 token, 403 quota, 503 loading, etc.)
-        return jsonify(payload), code
+    if not _is_valid_image(stream):
+        return ojson(_INVALID_IMAGE, 400)
+
+    key = _image_key(stream)
+    payload = _cache_get(key)
+    cached = payload is not None
+    if not cached:
+        payload, code = call_hf_inference(_upload_body(_shrink(stream)))
+        if code != 200:
+            # Propagate HF error details (401 token, 403 quota, 503 loading, etc.)
+            return ojson(payload, code)
 
     # Expect a list of {label, score}
     if not isinstance(payload, list) or not payload or not isinstance(payload[0], dict):
-        return jsonify({"error": "Unexpected HF response", "raw": payload}), 502
+        return ojson({"error": "Unexpected HF response", "raw": payload}, 502)
 
     try:
-        best = max(payload, key=lambda x: float(x.get("score", 0.0)))
-        topk = sorted(payload, key=lambda x: float(x.get("score", 0.0)), reverse=True)[:5]
+        topk = heapq.nlargest(5, payload, key=_score)
+        best = topk[0]
     except Exception:
-        return jsonify({"error": "Could not interpret HF scores", "raw": payload}), 502
+        return ojson({"error": "Could not interpret HF scores", "raw": payload}, 502)
+
+    if not cached:
+        _cache_put(key, payload)  # only well-formed results get cached
 
-    return jsonify({
+    return ojson({
         "predicted_class": best.get("label"),
-        "confidence": float(best.get("score", 0.0)),
+        "confidence": float(_score(best)),
         "topK": topk
-    }), 200
+    }, 200)
 
 
+# Local development only; production runs under gunicorn (gunicorn.conf.py)
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port)